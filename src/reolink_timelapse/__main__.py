@@ -4,11 +4,12 @@ import logging
 import signal
 import sys
 from datetime import datetime, timedelta
+from pathlib import Path
 
 from reolink_timelapse.capture import run_capture
 from reolink_timelapse.config import Settings
 from reolink_timelapse.nvr import ReolinkNVR
-from reolink_timelapse.stitch import run_stitch
+from reolink_timelapse.stitch import X264_PRESETS, run_stitch
 
 logging.basicConfig(
     level=logging.INFO,
@@ -18,6 +19,16 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
+def _run(coro) -> None:
+    """asyncio.run() on uvloop when the optional 'speedups' extra is installed."""
+    try:
+        import uvloop
+    except ImportError:
+        asyncio.run(coro)
+    else:
+        asyncio.run(coro, loop_factory=uvloop.new_event_loop)
+
+
 async def cmd_capture(settings: Settings) -> None:
     stop_event = asyncio.Event()
     loop = asyncio.get_running_loop()
@@ -31,14 +42,18 @@ async def cmd_capture(settings: Settings) -> None:
         f"=== Capture starting ===\n"
         f"  NVR          : {settings.nvr_host}\n"
         f"  Interval     : {settings.capture_interval_seconds}s\n"
+        f"  Concurrency  : {settings.snapshot_concurrency} snapshot(s) at a time\n"
         f"  Duration     : {settings.duration_hours}h  (until {end_time:%Y-%m-%d %H:%M:%S})\n"
         f"  Data dir     : {settings.data_dir}\n"
         f"  Est. frames  : ~{total_frames_est:,} per camera\n"
         f"  Storage estimate will update each interval once real frame sizes are known."
     )
 
+    # Capture persists its session so a crashed or killed run can be
+    # restarted without waiting for the NVR to free the old slot
     async with ReolinkNVR(
-        settings.nvr_host, settings.nvr_username, settings.nvr_password
+        settings.nvr_host, settings.nvr_username, settings.nvr_password,
+        state_path=Path(settings.data_dir) / ".nvr_session.json",
     ) as nvr:
         channels = await nvr.get_online_channels()
         if not channels:
@@ -69,7 +84,7 @@ async def cmd_capture(settings: Settings) -> None:
         stop_task = asyncio.create_task(_auto_stop())
         await run_capture(
             nvr, channels, settings.data_dir, settings.capture_interval_seconds,
-            stop_event, end_time,
+            stop_event, end_time, settings.snapshot_concurrency,
         )
         stop_task.cancel()
 
@@ -100,14 +115,33 @@ async def cmd_test(settings: Settings) -> None:
         sys.exit(1)
 
 
-async def cmd_stitch(settings: Settings, every_n_frames: int, output_fps: int) -> None:
+async def cmd_stitch(
+    settings: Settings,
+    every_n_frames: int,
+    output_fps: int,
+    parallel: int,
+    preset: str,
+    crf: int,
+    force: bool,
+    archive_encoder: str,
+    archive_crf: int,
+) -> None:
     logger.info(
         f"=== Stitch starting ===\n"
         f"  Data dir       : {settings.data_dir}\n"
         f"  Every N frames : {every_n_frames}\n"
-        f"  Output FPS     : {output_fps}"
+        f"  Output FPS     : {output_fps}\n"
+        f"  HW encoder     : {settings.hw_encoder or 'none (libx264)'}\n"
+        f"  x264 preset/crf: {preset} / {crf}\n"
+        f"  Archive enc/crf: {archive_encoder or 'none (same as 720p)'}"
+        f" / {archive_crf or 'default'}\n"
+        f"  Parallel       : {parallel or 'auto'}\n"
+        f"  Force          : {force}"
+    )
+    await run_stitch(
+        settings.data_dir, every_n_frames, output_fps, settings.hw_encoder, parallel,
+        preset, crf, force, archive_encoder, archive_crf,
     )
-    await run_stitch(settings.data_dir, every_n_frames, output_fps)
     logger.info("Stitch complete.")
 
 
@@ -156,14 +190,54 @@ Examples:
         metavar="FPS",
         help="Output video frame rate (default: OUTPUT_FPS env var, then 24)",
     )
+    sp_stitch.add_argument(
+        "--parallel",
+        type=int,
+        default=None,
+        metavar="N",
+        help="Channels to encode at once (default: STITCH_PARALLEL env var, then auto)",
+    )
+    sp_stitch.add_argument(
+        "--preset",
+        default=None,
+        choices=X264_PRESETS,
+        help="libx264 preset (default: X264_PRESET env var, then faster)",
+    )
+    sp_stitch.add_argument(
+        "--crf",
+        type=int,
+        default=None,
+        metavar="CRF",
+        help="libx264 quality, lower = better (default: X264_CRF env var, then 20)",
+    )
+    sp_stitch.add_argument(
+        "--archive-encoder",
+        default=None,
+        choices=("none", "libx265", "libsvtav1"),
+        help="Encoder for the full-res output only; 720p stays H.264.  'none' "
+             "overrides ARCHIVE_ENCODER (default: ARCHIVE_ENCODER env var, then none)",
+    )
+    sp_stitch.add_argument(
+        "--archive-crf",
+        type=int,
+        default=None,
+        metavar="CRF",
+        help="Quality for --archive-encoder, lower = better "
+             "(default: ARCHIVE_CRF env var, then the encoder's own default)",
+    )
+    sp_stitch.add_argument(
+        "--force",
+        action="store_true",
+        help="Re-encode channels even if their frames and settings are unchanged",
+    )
 
     args = parser.parse_args()
     settings = Settings()
 
     if args.mode == "test":
-        asyncio.run(cmd_test(settings))
+        _run(cmd_test(settings))
     elif args.mode == "capture":
-        asyncio.run(cmd_capture(settings))
+        _run(cmd_capture(settings))
     elif args.mode == "stitch":
         every_n_frames = (
             args.every_n_frames
@@ -171,7 +245,20 @@ Examples:
             else settings.stitch_every_n_frames
         )
         output_fps = args.fps if args.fps is not None else settings.output_fps
-        asyncio.run(cmd_stitch(settings, every_n_frames, output_fps))
+        parallel = args.parallel if args.parallel is not None else settings.stitch_parallel
+        preset = args.preset if args.preset is not None else settings.x264_preset
+        crf = args.crf if args.crf is not None else settings.x264_crf
+        if args.archive_encoder is not None:
+            archive_encoder = "" if args.archive_encoder == "none" else args.archive_encoder
+        else:
+            archive_encoder = settings.archive_encoder
+        archive_crf = (
+            args.archive_crf if args.archive_crf is not None else settings.archive_crf
+        )
+        _run(cmd_stitch(
+            settings, every_n_frames, output_fps, parallel, preset, crf, args.force,
+            archive_encoder, archive_crf,
+        ))
 
 
 if __name__ == "__main__":
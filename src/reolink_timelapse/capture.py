@@ -11,16 +11,23 @@ Using timestamp-based filenames means:
 """
 
 import asyncio
+import functools
 import logging
+import os
 import re
+import time
 from datetime import datetime
 from pathlib import Path
 
 logger = logging.getLogger(__name__)
 
+_WRITE_QUEUE_PER_CHANNEL = 64   # frames buffered per channel before capture waits on disk
+_SAFE_NAME_RE = re.compile(r"[^\w-]")
+_SNAPSHOT_GAP = 0.5             # seconds a snapshot slot rests before it is reused
+
 
 def _safe_name(name: str) -> str:
-    return re.sub(r"[^\w-]", "_", name)
+    return _SAFE_NAME_RE.sub("_", name)
 
 
 def _fmt_bytes(n: float) -> str:
@@ -32,23 +39,200 @@ def _fmt_bytes(n: float) -> str:
         return f"{n/1_000_000_000:.2f} GB"
 
 
-def _fmt_remaining(end_time: datetime) -> str:
-    secs = max(0.0, (end_time - datetime.now()).total_seconds())
+def _fmt_remaining(secs: float) -> str:
     h, rem = divmod(int(secs), 3600)
     m = rem // 60
     return f"{h}h {m:02d}m"
 
 
-async def _capture_one(nvr, channel_id: int, frame_dir: Path) -> int:
-    """Capture one snapshot. Returns bytes written, or 0 on failure."""
+@functools.lru_cache(maxsize=1)
+def _second_prefix(sec: int) -> str:
+    """YYYYMMDD_HHMMSS_ for a whole epoch second (local time)."""
+    tm = time.localtime(sec)
+    return "%04d%02d%02d_%02d%02d%02d_" % (
+        tm.tm_year, tm.tm_mon, tm.tm_mday, tm.tm_hour, tm.tm_min, tm.tm_sec,
+    )
+
+
+def _frame_name() -> str:
+    """
+    Return YYYYMMDD_HHMMSS_mmm.jpg for the current local time.
+    This runs for every frame, so it skips strftime, datetime and Path
+    objects; frames captured within the same second share a cached prefix.
+    """
+    t = time.time()
+    sec = int(t)
+    return "%s%03d.jpg" % (_second_prefix(sec), int((t - sec) * 1000))
+
+
+def _write_frame(dir_fd: int, name: str, data: bytes) -> None:
+    """
+    Write one frame with raw os calls (runs in a worker thread).  The file
+    is opened relative to the already-open channel directory, so only the
+    final path component is resolved.
+
+    Frames are never read back by this process — stitch reads them hours
+    later — so POSIX_FADV_DONTNEED starts their writeback early.  The pages
+    are still dirty at that point, so the kernel cannot drop them yet; it
+    reclaims them sooner once written back than if the flusher got there
+    on its own schedule.
+    """
+    fd = os.open(name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644, dir_fd=dir_fd)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+        if hasattr(os, "posix_fadvise"):  # Linux only
+            os.posix_fadvise(fd, 0, len(data), os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def _write_frames(batch: list[tuple[int, str, bytes]]) -> list[tuple[int, int]]:
+    """
+    Write a batch of queued frames in one worker-thread hop.
+    Returns (directory fd, size) for each frame that was written.
+    """
+    written: list[tuple[int, int]] = []
+    for dir_fd, name, data in batch:
+        try:
+            _write_frame(dir_fd, name, data)
+            written.append((dir_fd, len(data)))
+        except OSError as exc:
+            logger.warning(f"{name}: frame write failed: {exc}")
+    return written
+
+
+def _fsync_dirs(dir_fds: set[int]) -> None:
+    """fsync each directory so newly created frame entries survive a crash."""
+    for fd in dir_fds:
+        os.fsync(fd)
+
+
+class FrameWriter:
+    """
+    Bounded background writer for captured frames.
+
+    Snapshots are queued and written by a single worker task, so the capture
+    loop only waits on disk when the queue is full (backpressure keeps memory
+    bounded if storage stalls).  The worker takes everything queued at once
+    and writes it in a single thread hop, so a burst of frames costs one
+    handoff instead of one per frame.  Instead of syncing every file, sync()
+    fsyncs each touched frame directory once — call it once per capture round.
+
+    frames / nbytes count what actually reached disk, per directory fd.
+    """
+
+    def __init__(self, maxsize: int) -> None:
+        self._queue: asyncio.Queue[tuple[int, str, bytes]] = asyncio.Queue(maxsize)
+        self._dirty: set[int] = set()
+        self._worker: asyncio.Task | None = None
+        self.frames: dict[int, int] = {}
+        self.nbytes: dict[int, int] = {}
+
+    def start(self) -> None:
+        self._worker = asyncio.create_task(self._run())
+
+    async def put(self, dir_fd: int, name: str, data: bytes) -> None:
+        self._raise_if_stopped()
+        if self._queue.full():
+            await self._unless_stopped(self._queue.put((dir_fd, name, data)))
+        else:
+            self._queue.put_nowait((dir_fd, name, data))
+
+    def _raise_if_stopped(self) -> None:
+        """Re-raise whatever ended the worker, once it has ended."""
+        if self._worker is not None and self._worker.done():
+            exc = None if self._worker.cancelled() else self._worker.exception()
+            raise exc or RuntimeError("Frame writer has stopped")
+
+    async def _unless_stopped(self, coro) -> None:
+        """
+        Await coro, or raise if the worker dies first — a full queue (or a
+        join) would otherwise wait forever on a worker that is gone.
+        """
+        task = asyncio.ensure_future(coro)
+        try:
+            await asyncio.wait((task, self._worker), return_when=asyncio.FIRST_COMPLETED)
+        except BaseException:
+            task.cancel()
+            raise
+        if task.done():
+            return task.result()
+        task.cancel()
+        self._raise_if_stopped()
+
+    async def _run(self) -> None:
+        while True:
+            batch = [await self._queue.get()]
+            while not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            try:
+                written = await asyncio.to_thread(_write_frames, batch)
+            except Exception as exc:
+                # Keep the worker alive; a dead one would stall capture
+                logger.error(f"Frame writer: {len(batch)} frame(s) lost: {exc!r}")
+            else:
+                for dir_fd, size in written:
+                    self._dirty.add(dir_fd)
+                    self.frames[dir_fd] = self.frames.get(dir_fd, 0) + 1
+                    self.nbytes[dir_fd] = self.nbytes.get(dir_fd, 0) + size
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def sync(self) -> None:
+        """fsync the directories of every frame written since the last sync."""
+        dirs, self._dirty = self._dirty, set()
+        if not dirs:
+            return
+        try:
+            await asyncio.to_thread(_fsync_dirs, dirs)
+        except OSError as exc:
+            logger.warning(f"Frame directory fsync failed: {exc}")
+
+    async def aclose(self) -> None:
+        """Drain the queue, sync, and stop the worker."""
+        if self._worker is not None:
+            self._raise_if_stopped()
+            await self._unless_stopped(self._queue.join())
+        await self.sync()
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+
+
+async def _capture_one(nvr, writer: FrameWriter, channel_id: int, dir_fd: int) -> None:
+    """
+    Capture one snapshot and queue it for writing.  A failed snapshot is
+    logged and skipped; a dead writer is raised, since no frame can be saved.
+    """
     try:
         data = await nvr.capture_snapshot(channel_id)
-        ts = datetime.now().strftime("%Y%m%d_%H%M%S_%f")[:-3]  # ms precision
-        (frame_dir / f"{ts}.jpg").write_bytes(data)
-        return len(data)
     except Exception as exc:
         logger.warning(f"Channel {channel_id}: snapshot failed: {exc}")
-        return 0
+        return
+    await writer.put(dir_fd, _frame_name(), data)
+
+
+async def _capture_bounded(
+    sem: asyncio.Semaphore,
+    nvr,
+    writer: FrameWriter,
+    channel_id: int,
+    dir_fd: int,
+    stop_event: asyncio.Event,
+) -> None:
+    """_capture_one under the snapshot semaphore, followed by a short rest."""
+    async with sem:
+        await _capture_one(nvr, writer, channel_id, dir_fd)
+        # Holding the slot through the gap keeps requests spaced out; the
+        # NVR answers back-to-back snapshots with "get config failed" (-12).
+        if not stop_event.is_set():
+            await asyncio.sleep(_SNAPSHOT_GAP)
 
 
 async def run_capture(
@@ -58,8 +242,12 @@ async def run_capture(
     interval: float,
     stop_event: asyncio.Event,
     end_time: datetime,
+    concurrency: int = 1,
 ) -> dict[int, Path]:
-    """Capture snapshots from all channels until stop_event fires."""
+    """
+    Capture snapshots from all channels until stop_event fires.
+    At most `concurrency` snapshot requests are in flight at once.
+    """
 
     frame_dirs: dict[int, Path] = {}
     for ch in channels:
@@ -70,48 +258,77 @@ async def run_capture(
         frame_dirs[cid] = d
         logger.info(f"  Channel {cid} ({ch.get('name', '?')}) → {d}")
 
-    counts: dict[int, int] = {ch["channel"]: 0 for ch in channels}
-    total_bytes: dict[int, int] = {ch["channel"]: 0 for ch in channels}
-
-    while not stop_event.is_set():
-        # Capture channels sequentially with a small pause between each.
-        # Firing all snapshots simultaneously overloads the NVR and causes
-        # "get config failed" (-12) errors on some channels.
-        for ch in channels:
-            cid = ch["channel"]
-            nbytes = await _capture_one(nvr, cid, frame_dirs[cid])
-            if nbytes:
-                counts[cid] += 1
-                total_bytes[cid] += nbytes
-            if not stop_event.is_set():
-                await asyncio.sleep(0.5)
-
-        # Per-channel storage estimate based on actual average frame size
-        remaining_secs = max(0.0, (end_time - datetime.now()).total_seconds())
-        remaining_frames = remaining_secs / interval
-        lines = [f"Sleeping {interval:.0f}s | {_fmt_remaining(end_time)} remaining"]
-        for ch in channels:
-            cid = ch["channel"]
-            n = counts[cid]
-            if n:
-                avg = total_bytes[cid] / n
-                est_remaining = avg * remaining_frames
-                est_total = total_bytes[cid] + est_remaining
-                lines.append(
-                    f"  ch{cid} {ch.get('name', '?'):<20}"
-                    f"  {n:>5} frames"
-                    f"  avg {_fmt_bytes(avg):>8}/frame"
-                    f"  → ~{_fmt_bytes(est_remaining)} remaining"
-                    f"  (~{_fmt_bytes(est_total)} total)"
+    # Frame directories stay open for the whole run: frames are created
+    # relative to these fds and each round's fsync goes straight to them.
+    dir_fds = {
+        cid: os.open(d, os.O_RDONLY | os.O_DIRECTORY) for cid, d in frame_dirs.items()
+    }
+    writer = FrameWriter(maxsize=_WRITE_QUEUE_PER_CHANNEL * len(channels))
+    writer.start()
+    sem = asyncio.Semaphore(max(1, concurrency))
+    loop = asyncio.get_running_loop()
+    try:
+        while not stop_event.is_set():
+            # Rounds start every `interval` seconds measured start-to-start, so
+            # time spent capturing is absorbed by the wait rather than added
+            # to it.  A round that overruns is followed immediately by the next.
+            round_start = loop.time()
+
+            # Capture channels through a bounded semaphore.  Firing every
+            # snapshot at once overloads the NVR and causes "get config
+            # failed" (-12) errors; the default of 1 keeps them sequential.
+            await asyncio.gather(*(
+                _capture_bounded(
+                    sem, nvr, writer, ch["channel"],
+                    dir_fds[ch["channel"]], stop_event,
                 )
-            else:
-                lines.append(f"  ch{cid} {ch.get('name', '?'):<20}  no frames yet")
-        logger.info("\n".join(lines))
+                for ch in channels
+            ))
+
+            # One directory fsync per round rather than one per frame
+            await writer.sync()
+
+            wait = max(0.0, round_start + interval - loop.time())
+
+            # Per-channel storage estimate based on the average size of the
+            # frames written so far (frames still queued are not counted yet).
+            # Skipped entirely when INFO is filtered out; otherwise one lazy
+            # %-style record per line.
+            if logger.isEnabledFor(logging.INFO):
+                remaining_secs = max(0.0, (end_time - datetime.now()).total_seconds())
+                remaining_frames = remaining_secs / interval
+                logger.info(
+                    "Sleeping %.0fs | %s remaining", wait, _fmt_remaining(remaining_secs)
+                )
+                for ch in channels:
+                    cid = ch["channel"]
+                    n = writer.frames.get(dir_fds[cid], 0)
+                    if n:
+                        total = writer.nbytes[dir_fds[cid]]
+                        avg = total / n
+                        est_remaining = avg * remaining_frames
+                        logger.info(
+                            "  ch%d %-20s  %5d frames  avg %8s/frame"
+                            "  → ~%s remaining  (~%s total)",
+                            cid, ch.get("name", "?"), n, _fmt_bytes(avg),
+                            _fmt_bytes(est_remaining),
+                            _fmt_bytes(total + est_remaining),
+                        )
+                    else:
+                        logger.info("  ch%d %-20s  no frames yet", cid, ch.get("name", "?"))
 
+            try:
+                await asyncio.wait_for(stop_event.wait(), timeout=wait)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        # Make sure every queued frame reaches disk before we return
         try:
-            await asyncio.wait_for(stop_event.wait(), timeout=interval)
-        except asyncio.TimeoutError:
-            pass
+            await writer.aclose()
+        finally:
+            for fd in dir_fds.values():
+                os.close(fd)
 
+    counts = {cid: writer.frames.get(fd, 0) for cid, fd in dir_fds.items()}
     logger.info(f"Capture finished. Frame counts: {counts}")
     return frame_dirs
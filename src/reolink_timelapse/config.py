@@ -1,3 +1,5 @@
+from typing import Literal
+
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
@@ -19,10 +21,29 @@ class Settings(BaseSettings):
     # Comma-separated channel numbers to capture, e.g. "0,2,3".  Empty = all online channels.
     # Must be a plain string — pydantic-settings would try to JSON-decode a list[int] field.
     capture_channels: str = ""
+    # Max snapshot requests in flight at once.  This firmware answers parallel
+    # snapshots with rspCode -12, so raise it only if your NVR copes.
+    snapshot_concurrency: int = 1
 
     # Stitch settings
     stitch_every_n_frames: int = 1          # use every Nth captured frame (1 = all)
     output_fps: int = 24                    # output video frame rate
+    # Hardware H.264 encoder for stitch; empty = software libx264, "auto" =
+    # first that works.  Falls back to libx264 if the chosen one can't encode.
+    hw_encoder: Literal["", "auto", "nvenc", "qsv", "videotoolbox"] = ""
+    # libx264 speed/quality (ignored with a HW encoder); see run_stitch for the trade-off
+    x264_preset: Literal[
+        "ultrafast", "superfast", "veryfast", "faster", "fast",
+        "medium", "slow", "slower", "veryslow",
+    ] = "faster"
+    x264_crf: int = 20
+    # Encoder for the full-resolution output only (smaller archival files,
+    # much slower encode); empty = same as the 720p output
+    archive_encoder: Literal["", "libx265", "libsvtav1"] = ""
+    # CRF for ARCHIVE_ENCODER; 0 = its default (24 for libx265, 30 for libsvtav1)
+    archive_crf: int = 0
+    # Channels encoded at once; 0 = automatic (one per ~4 cores, 2 on a HW encoder)
+    stitch_parallel: int = 0
 
     # Storage (must be a mounted volume in Docker)
     data_dir: str = "/data"
@@ -1,33 +1,176 @@
 import asyncio
 import logging
+import os
 import random
-import string
 import time
+from pathlib import Path
+from urllib.parse import quote
 
 import httpx
+import orjson
 
 logger = logging.getLogger(__name__)
 
 _TOKEN_REFRESH_MARGIN = 300   # re-login this many seconds before expiry
+_TOKEN_REFRESH_LEAD = 5       # background refresh fires this long before that deadline
 _LOGIN_RETRIES = 5
 _LOGIN_RETRY_DELAY = 30       # seconds between login retries (rspCode -5 = session limit)
 _LOGOUT_TIMEOUT = 5.0         # seconds — must be well under docker stop_grace_period
+_SNAP_RETRIES = 3             # attempts per snapshot when the NVR reports busy (rspCode -12)
+_SNAP_RETRY_DELAY = 0.5       # base backoff in seconds; grows per attempt, with jitter
+_DETAIL_TTL = 3600            # seconds to reuse channel name/resolution/fps before re-querying
+
+# One NVR host, requests at most a couple at a time: a small pool is plenty.
+# Idle connections are kept past the default capture interval so each round
+# reuses the previous round's TCP connection instead of reconnecting; 75 s
+# matches the common server-side keep-alive default, so neither end is
+# likely to drop the socket first.
+# (HTTP/2 is not an option: the NVR serves plain HTTP/1.1 on port 80.)
+_HTTP_LIMITS = httpx.Limits(
+    max_connections=8, max_keepalive_connections=8, keepalive_expiry=75.0
+)
+_HTTP_TIMEOUT = httpx.Timeout(30.0, connect=5.0, pool=10.0)
+_HTTP_CONNECT_RETRIES = 1     # transport-level retry of failed TCP connects only
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
+# Request bodies that never change, serialized once at import
+_LOGOUT_BODY = orjson.dumps([{"cmd": "Logout", "action": 0, "param": {}}])
+_CHANNEL_STATUS_BODY = orjson.dumps([{"cmd": "GetChannelstatus", "action": 0, "param": {}}])
 
 
 class ReolinkNVR:
-    def __init__(self, host: str, username: str, password: str) -> None:
+    def __init__(
+        self, host: str, username: str, password: str, state_path: Path | None = None
+    ) -> None:
         self.host = host
         self.username = username
         self.password = password
+        # Where the live session is saved so a restart can reuse it (None = don't)
+        self._state_path = state_path
         self._token: str | None = None
-        self._token_time: float = 0.0
         self._token_ttl: int = 3600       # overwritten from actual leaseTime on login
+        # monotonic deadline after which the token must be refreshed
+        self._token_expires_at: float = 0.0
         self._login_lock = asyncio.Lock()
-        self._client = httpx.AsyncClient(timeout=30.0)
+        self._refresh_task: asyncio.Task | None = None
+        # Private PRNG for Snap cache-busters and retry jitter
+        self._rng = random.Random()
+        # channel → (monotonic fetch time, detail dict)
+        self._detail_cache: dict[int, tuple[float, dict]] = {}
+        # channel → Snap request in flight, shared by concurrent callers
+        self._inflight_snaps: dict[int, asyncio.Task[bytearray]] = {}
+        # Limits must go on the transport: AsyncClient ignores limits=
+        # when an explicit transport is supplied.
+        self._client = httpx.AsyncClient(
+            timeout=_HTTP_TIMEOUT,
+            transport=httpx.AsyncHTTPTransport(
+                limits=_HTTP_LIMITS, retries=_HTTP_CONNECT_RETRIES
+            ),
+            headers={"Connection": "keep-alive"},
+        )
         self._base_url = f"http://{host}/api.cgi"
+        # Snap is the per-frame hot path: fill in a preformatted query string
+        # rather than have httpx build and encode a params dict every call
+        self._snap_url = self._base_url + "?cmd=Snap&channel={}&rs={}&token={}"
+        # Credentials never change, so the Login body is serialized once
+        self._login_body = orjson.dumps([
+            {
+                "cmd": "Login",
+                "action": 0,
+                "param": {
+                    "User": {
+                        "Version": "0",
+                        "userName": username,
+                        "password": password,
+                    }
+                },
+            }
+        ])
+
+    @staticmethod
+    def _parse(resp: httpx.Response) -> list[dict]:
+        """
+        Decode an api.cgi JSON reply with orjson straight from the raw body,
+        skipping httpx's stdlib-json path and its charset detection.
+        """
+        return orjson.loads(resp.content)
 
     # ── Session management ────────────────────────────────────────────────
 
+    def _load_session(self) -> None:
+        """
+        Adopt the token saved by a previous run (e.g. one that crashed or was
+        SIGKILLed before logging out) if it is still short of its refresh
+        deadline — the slot it holds stays taken until it expires anyway.
+        """
+        if self._state_path is None:
+            return
+        try:
+            state = orjson.loads(self._state_path.read_bytes())
+        except FileNotFoundError:
+            return
+        except Exception as exc:
+            logger.warning(f"Ignoring unreadable session state {self._state_path}: {exc}")
+            return
+        # Valid JSON can still be truncated, hand-edited or from an older
+        # version: anything missing or of the wrong type means "log in".
+        if not isinstance(state, dict):
+            return
+        token = state.get("token")
+        expires_at = state.get("expires_at")
+        ttl = state.get("ttl")
+        if (
+            not token
+            or not isinstance(token, str)
+            or not isinstance(expires_at, (int, float))
+            or state.get("host") != self.host
+            or state.get("username") != self.username
+        ):
+            return
+        remaining = expires_at - time.time()
+        if remaining <= 0:
+            return
+        self._token = token
+        if isinstance(ttl, int) and ttl > 0:
+            self._token_ttl = ttl
+        self._token_expires_at = time.monotonic() + remaining
+        logger.info(f"Reusing saved NVR session ({remaining:.0f}s until refresh)")
+
+    def _save_session(self) -> None:
+        """Atomically persist the current token (wall-clock deadline, mode 0600)."""
+        if self._state_path is None:
+            return
+        state = {
+            "host": self.host,
+            "username": self.username,
+            "token": self._token,
+            "ttl": self._token_ttl,
+            "expires_at": time.time() + self._token_expires_at - time.monotonic(),
+        }
+        tmp = self._state_path.with_name(self._state_path.name + ".tmp")
+        try:
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "wb") as f:
+                f.write(orjson.dumps(state))
+            os.replace(tmp, self._state_path)
+        except OSError as exc:
+            logger.warning(f"Could not save NVR session state: {exc}")
+
+    def _clear_session(self) -> None:
+        if self._state_path is None:
+            return
+        try:
+            self._state_path.unlink(missing_ok=True)
+        except OSError as exc:
+            logger.warning(f"Could not remove NVR session state: {exc}")
+
+    def _drop_token(self, token: str) -> None:
+        """Forget a token the NVR rejected (-6), unless it was already replaced."""
+        if self._token == token:
+            self._token = None
+            self._token_expires_at = 0.0
+            self._clear_session()
+
     async def _logout(self) -> None:
         """
         Explicitly log out the current session so the NVR slot is freed
@@ -38,15 +181,17 @@ class ReolinkNVR:
             return
         token = self._token
         self._token = None
-        self._token_time = 0.0
+        self._token_expires_at = 0.0
+        self._clear_session()
         try:
             resp = await self._client.post(
                 self._base_url,
                 params={"cmd": "Logout", "token": token},
-                json=[{"cmd": "Logout", "action": 0, "param": {}}],
+                content=_LOGOUT_BODY,
+                headers=_JSON_HEADERS,
                 timeout=_LOGOUT_TIMEOUT,
             )
-            code = resp.json()[0].get("code", -1)
+            code = self._parse(resp)[0].get("code", -1)
             if code == 0:
                 logger.info("NVR session logged out")
             else:
@@ -78,34 +223,26 @@ class ReolinkNVR:
                 resp = await self._client.post(
                     self._base_url,
                     params={"cmd": "Login"},
-                    json=[
-                        {
-                            "cmd": "Login",
-                            "action": 0,
-                            "param": {
-                                "User": {
-                                    "Version": "0",
-                                    "userName": self.username,
-                                    "password": self.password,
-                                }
-                            },
-                        }
-                    ],
+                    content=self._login_body,
+                    headers=_JSON_HEADERS,
                 )
                 resp.raise_for_status()
             except Exception as exc:
                 logger.warning(f"Login HTTP error (attempt {attempt}/{_LOGIN_RETRIES}): {exc}")
                 continue
 
-            last_data = resp.json()[0]
+            last_data = self._parse(resp)[0]
             if last_data.get("code", -1) == 0:
                 token_data = last_data["value"]["Token"]
                 self._token = token_data["name"]
                 self._token_ttl = token_data.get("leaseTime", 3600)
-                self._token_time = time.monotonic()
+                self._token_expires_at = (
+                    time.monotonic() + self._token_ttl - _TOKEN_REFRESH_MARGIN
+                )
                 logger.info(
                     f"NVR login successful (token valid for {self._token_ttl}s)"
                 )
+                self._save_session()
                 return
 
             rsp_code = last_data.get("error", {}).get("rspCode")
@@ -119,100 +256,218 @@ class ReolinkNVR:
 
     async def _ensure_token(self) -> str:
         """
-        Return a valid token, logging in (once, under a lock) only when
-        the current token is absent or within _TOKEN_REFRESH_MARGIN of expiry.
+        Return the current token, logging in (once, under a lock) only when
+        there is none.  Expiry is _refresh_loop's job, so the hot path does
+        no clock read at all.
         """
-        # Fast path — no lock needed
-        if self._token is not None:
-            age = time.monotonic() - self._token_time
-            if age <= (self._token_ttl - _TOKEN_REFRESH_MARGIN):
-                return self._token
+        # Fast path — no lock, no clock; the refresh task keeps this current
+        token = self._token
+        if token is not None:
+            return token
 
-        # Slow path — serialize so exactly one coroutine logs in
+        # Slow path — bootstrap, or recovery after a failed refresh / -6
         async with self._login_lock:
-            age = time.monotonic() - self._token_time
-            if self._token is None or age > (self._token_ttl - _TOKEN_REFRESH_MARGIN):
+            if self._token is None and self._refresh_task is None:
+                self._load_session()
+            if self._token is None:
                 await self._login()
+            if self._refresh_task is None:
+                self._refresh_task = asyncio.create_task(self._refresh_loop())
             return self._token  # type: ignore[return-value]
 
+    async def _refresh_loop(self) -> None:
+        """
+        Re-login just before the refresh deadline.  This is the only place
+        expiry is checked: callers read the token as-is.  A refresh that
+        fails leaves _token cleared (the _logout inside _login does) and ends
+        the loop, so re-login is left to the next caller's slow path — which
+        starts a new loop — rather than retried here under the login lock.
+        """
+        while True:
+            lead_time = self._token_expires_at - _TOKEN_REFRESH_LEAD
+            await asyncio.sleep(max(0.0, lead_time - time.monotonic()))
+            async with self._login_lock:
+                # A caller may already have logged in while we slept
+                if time.monotonic() < self._token_expires_at - _TOKEN_REFRESH_LEAD:
+                    continue
+                try:
+                    await self._login()
+                except Exception as exc:
+                    logger.warning(f"Background token refresh failed: {exc}")
+                if self._token is None:
+                    self._refresh_task = None
+                    return
+
     # ── NVR queries ───────────────────────────────────────────────────────
 
     async def get_online_channels(self) -> list[dict]:
         """
         Return online channels, each enriched with 'name', 'resolution',
-        and 'fps'.  Detail requests are sequential to keep NVR load low.
+        and 'fps'.  Details come from one batched request to keep NVR load low.
         """
-        token = await self._ensure_token()
-        resp = await self._client.post(
-            self._base_url,
-            params={"cmd": "GetChannelstatus", "token": token},
-            json=[{"cmd": "GetChannelstatus", "action": 0, "param": {}}],
-        )
-        resp.raise_for_status()
-        data = resp.json()
+        for attempt in (1, 2):
+            token = await self._ensure_token()
+            resp = await self._client.post(
+                self._base_url,
+                params={"cmd": "GetChannelstatus", "token": token},
+                content=_CHANNEL_STATUS_BODY,
+                headers=_JSON_HEADERS,
+            )
+            resp.raise_for_status()
+            data = self._parse(resp)
+            if attempt == 1 and data[0].get("error", {}).get("rspCode") == -6:
+                # Token rejected — typically a saved session the NVR has
+                # since dropped (reboot, lease ended early); log in afresh
+                self._drop_token(token)
+                continue
+            break
         if data[0].get("code", -1) != 0:
             raise RuntimeError(f"GetChannelstatus failed: {data[0]}")
 
         online = [ch for ch in data[0]["value"]["status"] if ch.get("online") == 1]
+        channel_ids = [ch["channel"] for ch in online]
 
-        # Fetch name + encoding info sequentially — avoids hammering the NVR
-        # with a burst of parallel requests on startup
+        # Names + encoding info for every channel in one batched request,
+        # instead of two sequential round trips per channel
+        try:
+            details = await self._get_channel_details(channel_ids)
+        except Exception as exc:
+            logger.warning(f"Channel detail fetch failed: {exc}")
+            details = {}
         for ch in online:
-            try:
-                detail = await self._get_channel_detail(ch["channel"])
-                ch.update(detail)
-            except Exception as exc:
-                logger.warning(f"Channel {ch['channel']}: detail fetch failed: {exc}")
-                ch.setdefault("name", f"ch{ch['channel']}")
+            ch.update(details.get(ch["channel"], {}))
+            ch.setdefault("name", f"ch{ch['channel']}")
 
-        logger.info(f"Online channels: {[ch['channel'] for ch in online]}")
+        logger.info(f"Online channels: {channel_ids}")
         return online
 
-    async def _get_channel_detail(self, channel: int) -> dict:
-        """Fetch OSD name + main-stream encoding info for one channel."""
-        token = await self._ensure_token()
+    def refresh_details(self) -> None:
+        """Forget cached channel details so the next lookup re-queries the NVR."""
+        self._detail_cache.clear()
 
-        resp = await self._client.post(
-            self._base_url,
-            params={"cmd": "GetOsd", "token": token},
-            json=[{"cmd": "GetOsd", "action": 0, "param": {"channel": channel}}],
-        )
-        resp.raise_for_status()
-        name = (
-            resp.json()[0].get("value", {})
-            .get("Osd", {})
-            .get("osdChannel", {})
-            .get("name", f"ch{channel}")
-        )
+    async def _get_channel_details(self, channels: list[int]) -> dict[int, dict]:
+        """
+        Return OSD name + main-stream encoding info for several channels.
+        Details change on human timescales, so answers are cached for
+        _DETAIL_TTL; only missing or stale channels are queried.
+        """
+        now = time.monotonic()
+        cached = {
+            c: entry[1] for c in channels
+            if (entry := self._detail_cache.get(c)) and now - entry[0] < _DETAIL_TTL
+        }
+        stale = [c for c in channels if c not in cached]
+        if stale:
+            fetched = await self._fetch_channel_details(stale)
+            cached.update(fetched)
+        return {c: dict(cached[c]) for c in channels}
+
+    async def _fetch_channel_details(self, channels: list[int]) -> dict[int, dict]:
+        """
+        Query OSD name + main-stream encoding info for several channels.
+        api.cgi accepts an array of commands, so all GetOsd + GetEnc calls go
+        out as a single POST (token only in the query — no per-request cmd).
+        Channels for which both commands answered are added to the cache.
+        """
+        token = await self._ensure_token()
 
         resp = await self._client.post(
             self._base_url,
-            params={"cmd": "GetEnc", "token": token},
-            json=[{"cmd": "GetEnc", "action": 0, "param": {"channel": channel}}],
+            params={"token": token},
+            content=orjson.dumps(
+                [{"cmd": "GetOsd", "action": 0, "param": {"channel": c}} for c in channels]
+                + [{"cmd": "GetEnc", "action": 0, "param": {"channel": c}} for c in channels]
+            ),
+            headers=_JSON_HEADERS,
         )
         resp.raise_for_status()
-        main = resp.json()[0].get("value", {}).get("Enc", {}).get("mainStream", {})
+        data = self._parse(resp)
 
-        return {
-            "name": name,
-            "resolution": main.get("size", "?"),
-            "fps": main.get("frameRate", "?"),
+        details: dict[int, dict] = {
+            c: {"name": f"ch{c}", "resolution": "?", "fps": "?"} for c in channels
         }
+        answered = dict.fromkeys(channels, 0)
+        # Key each answer by the channel it reports rather than by position:
+        # a failed command comes back as an error entry, and a reply with a
+        # missing entry would shift a positional split onto the wrong channels.
+        for i, rsp in enumerate(data):
+            if rsp.get("code", -1) != 0:
+                logger.warning(f"{rsp.get('cmd', '?')} failed: {rsp.get('error')}")
+                continue
+            value = rsp.get("value", {})
+            payload = value.get("Osd") or value.get("Enc") or {}
+            channel = payload.get("channel", channels[i % len(channels)])
+            detail = details.get(channel)
+            if detail is None:
+                continue
+            if "Osd" in value:
+                detail["name"] = payload.get("osdChannel", {}).get("name", detail["name"])
+            elif "Enc" in value:
+                main = payload.get("mainStream", {})
+                detail["resolution"] = main.get("size", "?")
+                detail["fps"] = main.get("frameRate", "?")
+            else:
+                continue
+            answered[channel] += 1
+
+        fetched_at = time.monotonic()
+        for c, n in answered.items():
+            if n == 2:
+                self._detail_cache[c] = (fetched_at, dict(details[c]))
+        return details
+
+    async def capture_snapshot(self, channel: int) -> bytearray:
+        """
+        Fetch one JPEG.  Callers that ask for a channel while a snapshot of it
+        is already in flight share that request's result instead of making
+        the NVR encode a second frame.  The returned buffer may therefore be
+        shared — treat it as read-only.
+        """
+        task = self._inflight_snaps.get(channel)
+        if task is None:
+            task = asyncio.create_task(self._fetch_snapshot(channel))
+            self._inflight_snaps[channel] = task
+            task.add_done_callback(lambda t: self._snap_done(channel, t))
+        # Shielded so one caller being cancelled doesn't cancel the others
+        return await asyncio.shield(task)
+
+    def _snap_done(self, channel: int, task: asyncio.Task) -> None:
+        if self._inflight_snaps.get(channel) is task:
+            del self._inflight_snaps[channel]
+        # Mark the outcome retrieved: if every waiter was cancelled, asyncio
+        # would otherwise log "Task exception was never retrieved".
+        if not task.cancelled():
+            task.exception()
+
+    async def _fetch_snapshot(self, channel: int) -> bytearray:
+        """
+        Fetch one JPEG.  The body is streamed straight into a single bytearray
+        (no joined-chunks bytes copy); callers can hand it to os.write as-is.
+        rspCode -12 ("NVR busy") is retried with jittered backoff.
+        """
+        attempt = 1
+        while True:
+            token = await self._ensure_token()
+            rs = f"{self._rng.getrandbits(48):012x}"  # cache-buster; needs no crypto strength
+            url = self._snap_url.format(channel, rs, quote(token, safe=""))
+            async with self._client.stream("GET", url) as resp:
+                resp.raise_for_status()
+                # Headers arrive before the body, so the JPEG/error decision is
+                # made up front: only an image is streamed into the frame
+                # buffer, anything else is a short JSON error read in one go.
+                if "image" in resp.headers.get("content-type", ""):
+                    buf = bytearray()
+                    # aiter_bytes, not aiter_raw: a gzipped response (from a
+                    # proxy, say) must be decoded, not saved as the .jpg
+                    async for chunk in resp.aiter_bytes():
+                        buf += chunk
+                    return buf
+                error_body = await resp.aread()
 
-    async def capture_snapshot(self, channel: int) -> bytes:
-        token = await self._ensure_token()
-        rs = "".join(random.choices(string.ascii_lowercase + string.digits, k=8))
-        resp = await self._client.get(
-            self._base_url,
-            params={"cmd": "Snap", "channel": channel, "rs": rs, "token": token},
-        )
-        resp.raise_for_status()
-        content_type = resp.headers.get("content-type", "")
-        if "image" not in content_type:
             rsp_code: int | None = None
-            detail: str = resp.text[:300]
+            detail: str = error_body[:300].decode(errors="replace")
             try:
-                body = resp.json()
+                body = orjson.loads(error_body)
                 rsp_code = body[0]["error"]["rspCode"]
                 detail = body[0]["error"]["detail"]
             except Exception:
@@ -220,13 +475,30 @@ class ReolinkNVR:
             # Only invalidate the token on actual auth errors; transient NVR
             # errors (-12 "get config failed", etc.) leave the token intact.
             if rsp_code == -6:
-                self._token_time = 0.0
-            raise RuntimeError(f"Snap rspCode={rsp_code}: {detail}")
-        return resp.content
+                self._drop_token(token)
+            if rsp_code != -12 or attempt >= _SNAP_RETRIES:
+                raise RuntimeError(f"Snap rspCode={rsp_code}: {detail}")
+
+            delay = _SNAP_RETRY_DELAY * attempt * self._rng.uniform(0.5, 1.5)
+            logger.info(
+                f"Channel {channel}: NVR busy (rspCode=-12), "
+                f"retry {attempt + 1}/{_SNAP_RETRIES} in {delay:.1f}s"
+            )
+            await asyncio.sleep(delay)
+            attempt += 1
 
     # ── Lifecycle ─────────────────────────────────────────────────────────
 
     async def aclose(self) -> None:
+        for task in list(self._inflight_snaps.values()):
+            task.cancel()
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+            try:
+                await self._refresh_task
+            except asyncio.CancelledError:
+                pass
+            self._refresh_task = None
         await self._logout()
         await self._client.aclose()
 
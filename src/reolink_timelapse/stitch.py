@@ -24,8 +24,12 @@ Output duration math
 """
 
 import asyncio
+import hashlib
 import logging
+import os
 import tempfile
+from collections import deque
+from datetime import datetime
 from pathlib import Path
 
 logger = logging.getLogger(__name__)
@@ -34,20 +38,189 @@ logger = logging.getLogger(__name__)
 # rounded to the nearest even number (required by libx264).
 _SCALE_720P = "scale=-2:720"
 
+# One filter graph feeds both encoders: each decoded frame is converted to
+# yuv420p once, then split — [full] goes out as-is, [v720] is scaled.
+_FILTER_GRAPH = f"[0:v]format=yuv420p,split=2[full][small];[small]{_SCALE_720P}[v720]"
 
-def _date_suffix(frames: list[Path]) -> str:
+# libx264 presets, fastest first.  The 720p output is a sharing copy, so it
+# is encoded with _PRESET_720P (or the main preset, if that is faster).
+X264_PRESETS = (
+    "ultrafast", "superfast", "veryfast", "faster", "fast",
+    "medium", "slow", "slower", "veryslow",
+)
+_PRESET_720P = "veryfast"
+# Timelapse frames are stills from fixed cameras, not film motion
+_X264_TUNE = "stillimage"
+
+# ffmpeg stderr kept for the error log, in 4 KiB reads (≈ last 64 KiB)
+_STDERR_TAIL_CHUNKS = 16
+
+# libx264 scales well to ~4 threads per encode; beyond that, running more
+# channels side by side uses the cores better than one wide encode.
+_CORES_PER_ENCODE = 4
+
+# Hardware encoders have few sessions (consumer NVENC allows a handful, and
+# each channel opens two), so fewer channels run at once when one is used.
+_HW_PARALLEL_ENCODES = 2
+
+# Video codec arguments per encoder.  libx264 gets -preset/-crf appended
+# from X264_PRESET / X264_CRF; the hardware entries (selected via
+# HW_ENCODER) are tuned for roughly the visual quality of CRF 18–20.
+_CODEC_ARGS: dict[str, list[str]] = {
+    "libx264": ["-c:v", "libx264"],
+    "nvenc": ["-c:v", "h264_nvenc", "-preset", "p5", "-rc", "vbr", "-cq", "20", "-b:v", "0"],
+    "qsv": ["-c:v", "h264_qsv", "-global_quality", "20", "-look_ahead", "1"],
+    "videotoolbox": ["-c:v", "h264_videotoolbox", "-q:v", "55"],
+}
+# Order in which HW_ENCODER=auto tries the hardware encoders
+_HW_AUTO_ORDER = ("nvenc", "qsv", "videotoolbox")
+
+# Software encoders for the full-resolution output only (ARCHIVE_ENCODER),
+# trading encode time for smaller archival files; the 720p sharing copy
+# stays H.264 so it plays anywhere.  SVT-AV1 preset 8 gives files roughly
+# 40 % smaller than libx264 at similar quality and scales well across cores.
+# -crf is appended from ARCHIVE_CRF, or _ARCHIVE_DEFAULT_CRF when that is 0.
+_ARCHIVE_CODEC_ARGS: dict[str, list[str]] = {
+    "libx265": ["-c:v", "libx265", "-preset", "medium", "-tag:v", "hvc1"],
+    "libsvtav1": ["-c:v", "libsvtav1", "-preset", "8", "-svtav1-params", "tune=0"],
+}
+_ARCHIVE_DEFAULT_CRF = {"libx265": 24, "libsvtav1": 30}
+
+
+def _usable_cpus() -> int:
+    """CPUs this process may run on (a cpuset can allow fewer than the host has)."""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def _encode_slots(n_channels: int, hw: bool, max_parallel: int = 0) -> tuple[int, int]:
+    """
+    Return (channels encoded at once, ffmpeg threads per encode).
+    max_parallel overrides the automatic limit when non-zero.
+    """
+    cpus = _usable_cpus()
+    limit = max_parallel or (_HW_PARALLEL_ENCODES if hw else cpus // _CORES_PER_ENCODE)
+    parallel = max(1, min(n_channels, limit))
+    return parallel, max(1, cpus // parallel)
+
+
+def _cpu_slices(parallel: int) -> list[set[int] | None]:
+    """
+    Split the CPUs this process may run on into `parallel` disjoint sets,
+    one per concurrent encode, so each ffmpeg's x264 threads stay on (and
+    keep the caches of) their own cores.  All None where there is nothing
+    to split or the platform has no sched_setaffinity.
+    """
+    if parallel < 2 or not hasattr(os, "sched_setaffinity"):
+        return [None] * parallel
+    cpus = sorted(os.sched_getaffinity(0))
+    per = len(cpus) // parallel
+    if per == 0:
+        return [None] * parallel
+    # Contiguous runs; the last slice also takes any remainder
+    return [
+        set(cpus[i * per:(i + 1) * per if i < parallel - 1 else None])
+        for i in range(parallel)
+    ]
+
+
+async def _ffmpeg_encoders() -> set[str]:
+    """Return the names of the video encoders compiled into this ffmpeg."""
+    proc = await asyncio.create_subprocess_exec(
+        "ffmpeg", "-hide_banner", "-encoders",
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.DEVNULL,
+    )
+    stdout, _ = await proc.communicate()
+    # Lines look like " V....D h264_nvenc   NVIDIA NVENC H.264 encoder"
+    return {
+        fields[1]
+        for line in stdout.decode(errors="replace").splitlines()
+        if len(fields := line.split()) > 1 and fields[0].startswith("V")
+    }
+
+
+async def _encoder_works(codec: str) -> bool:
+    """
+    Try a one-frame test encode.  ffmpeg lists every encoder it was built
+    with, whether or not this machine (or container) has the device for it.
+    """
+    proc = await asyncio.create_subprocess_exec(
+        "ffmpeg", "-hide_banner", "-loglevel", "error",
+        "-f", "lavfi", "-i", "color=black:size=256x256",
+        "-frames:v", "1", "-c:v", codec, "-f", "null", "-",
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.DEVNULL,
+    )
+    return await proc.wait() == 0
+
+
+async def _resolve_encoder(hw_encoder: str) -> str:
+    """
+    Map HW_ENCODER to a _CODEC_ARGS key: the requested hardware encoder, or
+    for "auto" the first one in _HW_AUTO_ORDER, that ffmpeg has and that
+    passes a test encode.  Falls back to libx264.
+    """
+    if not hw_encoder:
+        return "libx264"
+    candidates = _HW_AUTO_ORDER if hw_encoder == "auto" else (hw_encoder,)
+    available = await _ffmpeg_encoders()
+    for name in candidates:
+        codec = _CODEC_ARGS[name][1]
+        if codec in available and await _encoder_works(codec):
+            return name
+    logger.warning(f"No usable hardware encoder ({hw_encoder}) — falling back to libx264")
+    return "libx264"
+
+
+async def _resolve_archive_encoder(archive_encoder: str) -> str:
+    """
+    Return ARCHIVE_ENCODER if this ffmpeg was built with it, else "" (the
+    full-resolution output then uses the same encoder as the 720p one).
+    """
+    if not archive_encoder:
+        return ""
+    if archive_encoder in await _ffmpeg_encoders():
+        return archive_encoder
+    logger.warning(
+        f"ffmpeg has no {archive_encoder} encoder — full-res output stays on "
+        f"the 720p encoder"
+    )
+    return ""
+
+
+def _date_suffix(first_frame: str, last_frame: str) -> str:
     """Return a date suffix derived from the first and last frame filenames.
 
     Frame names are YYYYMMDD_HHMMSS_mmm.jpg.  If both dates are the same,
     returns '_YYYY-MM-DD'; otherwise '_YYYY-MM-DD_YYYY-MM-DD'.
     """
-    def fmt(stem: str) -> str:
-        d = stem[:8]
-        return f"{d[:4]}-{d[4:6]}-{d[6:8]}"
+    first = datetime.strptime(first_frame[:8], "%Y%m%d").date()
+    last = datetime.strptime(last_frame[:8], "%Y%m%d").date()
+    if first == last:
+        return f"_{first.isoformat()}"
+    return f"_{first.isoformat()}_{last.isoformat()}"
+
+
+def _up_to_date(frame_dir: Path, last_frame: str, outputs: tuple[Path, ...]) -> bool:
+    """
+    True if every output is newer than the channel's frames.  The directory
+    mtime moves whenever a frame is added or deleted; the newest frame's
+    own mtime covers one still being written.
+    """
+    try:
+        newest = max(frame_dir.stat().st_mtime, (frame_dir / last_frame).stat().st_mtime)
+        return all(out.stat().st_mtime > newest for out in outputs)
+    except FileNotFoundError:
+        return False
 
-    first = fmt(frames[0].stem)
-    last = fmt(frames[-1].stem)
-    return f"_{first}" if first == last else f"_{first}_{last}"
+
+def _read_stamp(stamp_file: Path) -> str | None:
+    try:
+        return stamp_file.read_text().strip()
+    except FileNotFoundError:
+        return None
 
 
 async def _encode_channel(
@@ -56,17 +229,42 @@ async def _encode_channel(
     output_720p: Path,
     every_n_frames: int,
     output_fps: int,
+    codec_full: list[str],
+    codec_720p: list[str],
+    threads: int,
+    work_dir: Path,
+    hwaccel: bool = False,
+    force: bool = False,
+    cpus: set[int] | None = None,
 ) -> None:
-    frames = sorted(frame_dir.glob("*.jpg"))
+    # Plain file names straight from scandir: sorting str is far cheaper
+    # than Path comparisons, and the names sort chronologically as-is.
+    with os.scandir(frame_dir) as entries:
+        frames = sorted(e.name for e in entries if e.name.endswith(".jpg"))
     if not frames:
         logger.warning(f"No frames in {frame_dir} — skipping")
         return
 
-    selected = frames[::every_n_frames]
+    # Indices of the frames to keep.  A range is constant-size, whereas
+    # frames[::n] would copy every selected name into a second list.
+    selected = range(0, len(frames), every_n_frames)
 
-    suffix = _date_suffix(selected)
+    # sha256 of the concat list + encode settings from the channel's last
+    # successful encode.  Named per channel, not per date range, so a new
+    # last-frame date replaces the stamp instead of orphaning it.
+    stamp_file = output_full.with_name(f".{output_full.stem}.sha256")
+    suffix = _date_suffix(frames[0], frames[selected[-1]])
     output_full = output_full.with_stem(output_full.stem + suffix)
     output_720p = output_720p.with_stem(output_720p.stem + suffix)
+    outputs = (output_full, output_720p)
+    # Videos from before stamps existed only have the mtime check to go on
+    legacy = not stamp_file.exists()
+    if not force and legacy and _up_to_date(frame_dir, frames[-1], outputs):
+        logger.info(
+            f"{frame_dir.name}: {output_full.name} is newer than every frame — "
+            f"skipping (use --force to re-encode, e.g. after changing settings)"
+        )
+        return
     video_s = len(selected) / output_fps
     logger.info(
         f"{frame_dir.name}: {len(frames)} frames, "
@@ -78,44 +276,107 @@ async def _encode_channel(
     # Each entry: "file '/abs/path.jpg'\nduration <secs>"
     # The last file must be repeated without a duration to avoid a 1-frame
     # green flash at the end (ffmpeg concat demuxer quirk).
+    # Piping the JPEGs through stdin (image2pipe) was considered and rejected:
+    # every byte would be copied through Python first, and the mjpeg pipe
+    # parser can't tell where a damaged or half-written frame ends (stitch
+    # may run while capture is still writing), whereas concat opens each
+    # file on its own.
+    # Every frame sits directly in frame_dir, so its absolute path is
+    # resolved once and entries are written straight out as bytes — no
+    # per-frame Path.absolute() and no list + join of the whole file.
     frame_dur = 1.0 / output_fps
-    lines: list[str] = []
-    for f in selected:
-        lines.append(f"file '{f.absolute()}'")
-        lines.append(f"duration {frame_dur:.6f}")
-    lines.append(f"file '{selected[-1].absolute()}'")
+    entry_head = b"file '" + os.fsencode(frame_dir.absolute()) + b"/"
+    entry_tail = f"'\nduration {frame_dur:.6f}\n".encode()
 
-    with tempfile.NamedTemporaryFile(mode="w", suffix=".txt", delete=False) as tmp:
-        tmp.write("\n".join(lines))
-        concat_file = tmp.name
+    # 1 MiB buffer: a long channel's list goes out in a few large writes.
+    # The list is hashed as it is written, then the settings that shape the
+    # output are folded in: an identical digest means an identical encode.
+    concat_file = work_dir / f"{frame_dir.name}.txt"
+    digest = hashlib.sha256()
+    with open(concat_file, "wb", buffering=1 << 20) as f:
+        for i in selected:
+            entry = entry_head + os.fsencode(frames[i]) + entry_tail
+            f.write(entry)
+            digest.update(entry)
+        f.write(entry_head + os.fsencode(frames[selected[-1]]) + b"'")
+    settings = [*codec_full, "|", *codec_720p, "|", _FILTER_GRAPH, f"hwaccel={hwaccel}"]
+    digest.update(" ".join(settings).encode())
+    stamp = digest.hexdigest()
+
+    unchanged = all(out.exists() for out in outputs) and _read_stamp(stamp_file) == stamp
+    if not force and unchanged:
+        logger.info(
+            f"{frame_dir.name}: frames and settings unchanged since last encode — skipping"
+        )
+        concat_file.unlink()
+        return
 
     # Single ffmpeg call, two outputs — input is decoded only once.
     #   Output 1: full resolution
     #   Output 2: scaled to 720p
+    # The two encoders share this channel's thread budget: 720p has a
+    # quarter or less of the pixels, so it gets a quarter of the threads.
+    threads_720p = max(1, threads // 4)
+    threads_full = max(1, threads - threads_720p)
+    # libx265 ignores -threads; its thread pool is sized through x265-params
+    if codec_full[1] == "libx265":
+        threads_full_args = ["-x265-params", f"pools={threads_full}"]
+    else:
+        threads_full_args = ["-threads", str(threads_full)]
+    # Both are written under hidden names and renamed only on success, so a
+    # failed or killed encode never leaves an output the up-to-date check
+    # would mistake for a finished one.
+    partial_full = output_full.with_name(f".{output_full.name}")
+    partial_720p = output_720p.with_name(f".{output_720p.name}")
     try:
         cmd = [
-            "ffmpeg", "-y",
-            "-f", "concat", "-safe", "0", "-i", concat_file,
+            # -nostats: no \r progress lines, so stderr is just the log
+            "ffmpeg", "-y", "-hide_banner", "-nostats",
+            # Let a hardware encoder's device decode the JPEGs too, where it
+            # can; "auto" quietly falls back to software decoding otherwise
+            *(["-hwaccel", "auto"] if hwaccel else []),
+            # Frames carry video only; block the other stream types outright
+            "-an", "-sn", "-dn",
+            "-f", "concat", "-safe", "0", "-i", str(concat_file),
+            "-filter_complex", _FILTER_GRAPH,
             # ── full resolution ──
-            "-c:v", "libx264", "-preset", "slow", "-crf", "18",
-            "-pix_fmt", "yuv420p", "-movflags", "+faststart",
-            str(output_full),
+            "-map", "[full]",
+            *codec_full, *threads_full_args,
+            "-movflags", "+faststart",
+            str(partial_full),
             # ── 720p ──
-            "-vf", _SCALE_720P,
-            "-c:v", "libx264", "-preset", "slow", "-crf", "18",
-            "-pix_fmt", "yuv420p", "-movflags", "+faststart",
-            str(output_720p),
+            "-map", "[v720]",
+            *codec_720p, "-threads", str(threads_720p),
+            "-movflags", "+faststart",
+            str(partial_720p),
         ]
         logger.info(f"Encoding {output_full.name} + {output_720p.name} ...")
         proc = await asyncio.create_subprocess_exec(
             *cmd,
-            stdout=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.DEVNULL,
             stderr=asyncio.subprocess.PIPE,
         )
-        _, stderr = await proc.communicate()
-        if proc.returncode != 0:
-            logger.error(f"ffmpeg error:\n{stderr.decode()}")
+        # Pinned straight after spawn, before ffmpeg has parsed its arguments
+        # or started any encoder threads, so every thread inherits the set.
+        # (preexec_fn would do it pre-exec, but is unsafe with threads about.)
+        if cpus:
+            try:
+                os.sched_setaffinity(proc.pid, cpus)
+            except ProcessLookupError:
+                pass  # already exited; the return code below says why
+        # stderr only matters on failure: keep just its tail, not all of it
+        tail: deque[bytes] = deque(maxlen=_STDERR_TAIL_CHUNKS)
+        while chunk := await proc.stderr.read(4096):
+            tail.append(chunk)
+        if await proc.wait() != 0:
+            logger.error(f"ffmpeg error:\n{b''.join(tail).decode(errors='replace')}")
             raise RuntimeError(f"ffmpeg failed for {frame_dir.name}")
+        os.replace(partial_full, output_full)
+        os.replace(partial_720p, output_720p)
+        # Atomic like the videos, so a crash can't leave a truncated stamp
+        partial_stamp = stamp_file.with_name(stamp_file.name + ".tmp")
+        partial_stamp.write_text(stamp + "\n")
+        os.replace(partial_stamp, stamp_file)
 
         full_mb = output_full.stat().st_size / 1_000_000
         p720_mb = output_720p.stat().st_size / 1_000_000
@@ -124,10 +385,43 @@ async def _encode_channel(
             f"  +  {output_720p.name} ({p720_mb:.1f} MB)"
         )
     finally:
-        Path(concat_file).unlink(missing_ok=True)
+        concat_file.unlink(missing_ok=True)
+        partial_full.unlink(missing_ok=True)
+        partial_720p.unlink(missing_ok=True)
+
+
+async def run_stitch(
+    data_dir: str,
+    every_n_frames: int,
+    output_fps: int,
+    hw_encoder: str = "",
+    max_parallel: int = 0,
+    preset: str = "faster",
+    crf: int = 20,
+    force: bool = False,
+    archive_encoder: str = "",
+    archive_crf: int = 0,
+) -> None:
+    """
+    Encode every channel under <data_dir>/frames.  preset/crf apply to
+    libx264 only; the 720p copy uses at most _PRESET_720P.  Rough libx264
+    trade-off for timelapse footage (mostly static scenes):
+
+      preset    relative encode time   notes
+      faster    1×                     default; visually indistinguishable
+      medium    ~1.5×                  a few % smaller files
+      slow      ~2.5×                  ~5–10 % smaller files
 
+    Lower crf = higher quality and larger files (18 ≈ visually lossless,
+    20 is the default, 23 is libx264's own default).
 
-async def run_stitch(data_dir: str, every_n_frames: int, output_fps: int) -> None:
+    archive_encoder ("libx265" or "libsvtav1") replaces the encoder for the
+    full-resolution output only, at archive_crf (0 = that encoder's
+    default); see _ARCHIVE_CODEC_ARGS.
+
+    Channels whose frames and settings are unchanged since their last
+    encode are skipped unless force is set.
+    """
     frames_base = Path(data_dir) / "frames"
     video_dir = Path(data_dir) / "videos"
     video_dir.mkdir(parents=True, exist_ok=True)
@@ -141,14 +435,77 @@ async def run_stitch(data_dir: str, every_n_frames: int, output_fps: int) -> Non
         logger.error(f"No channel sub-directories found under {frames_base}")
         return
 
-    for ch_dir in channel_dirs:
+    # Channels are independent, so encode several at once (bounded so the
+    # ffmpeg processes together roughly fill, not oversubscribe, the CPUs).
+    encoder = await _resolve_encoder(hw_encoder)
+    codec_full = codec_720p = _CODEC_ARGS[encoder]
+    if encoder == "libx264":
+        preset_720p = min(preset, _PRESET_720P, key=X264_PRESETS.index)
+        x264_args = ["-tune", _X264_TUNE, "-crf", str(crf)]
+        codec_full = [*codec_full, "-preset", preset, *x264_args]
+        codec_720p = [*codec_720p, "-preset", preset_720p, *x264_args]
+    archive_encoder = await _resolve_archive_encoder(archive_encoder)
+    if archive_encoder:
+        crf_full = archive_crf or _ARCHIVE_DEFAULT_CRF[archive_encoder]
+        codec_full = [*_ARCHIVE_CODEC_ARGS[archive_encoder], "-crf", str(crf_full)]
+        if encoder == "libx264":
+            logger.info(
+                f"Full-res output uses {archive_encoder} at crf {crf_full}; "
+                f"x264 preset/crf ({preset}/{crf}) apply to the 720p copy only"
+            )
+    # A software archive encode is CPU-bound even alongside a HW 720p encoder
+    parallel, threads = _encode_slots(
+        len(channel_dirs),
+        hw=encoder != "libx264" and not archive_encoder,
+        max_parallel=max_parallel,
+    )
+    logger.info(
+        f"Encoding {len(channel_dirs)} channel(s) with {codec_full[1]} "
+        f"(720p: {codec_720p[1]}), {parallel} at a time "
+        f"({threads} ffmpeg thread(s) each)"
+    )
+    # One CPU slice per concurrent encode; the queue doubles as the
+    # concurrency bound — a channel waits until a slice is free.
+    cpu_slices: asyncio.Queue[set[int] | None] = asyncio.Queue()
+    for cpu_slice in _cpu_slices(parallel):
+        cpu_slices.put_nowait(cpu_slice)
+
+    async def _encode_one(ch_dir: Path, work_dir: Path) -> None:
         stem = f"timelapse_{ch_dir.name}"
-        await _encode_channel(
-            ch_dir,
-            output_full=video_dir / f"{stem}.mp4",
-            output_720p=video_dir / f"{stem}_720p.mp4",
-            every_n_frames=every_n_frames,
-            output_fps=output_fps,
+        cpus = await cpu_slices.get()
+        try:
+            await _encode_channel(
+                ch_dir,
+                output_full=video_dir / f"{stem}.mp4",
+                output_720p=video_dir / f"{stem}_720p.mp4",
+                every_n_frames=every_n_frames,
+                output_fps=output_fps,
+                codec_full=codec_full,
+                codec_720p=codec_720p,
+                threads=threads,
+                work_dir=work_dir,
+                hwaccel=encoder != "libx264",
+                force=force,
+                cpus=cpus,
+            )
+        finally:
+            cpu_slices.put_nowait(cpus)
+
+    # Concat lists for this run live in one private temp dir, removed in a
+    # single sweep at the end (even if an encode raises)
+    with tempfile.TemporaryDirectory(prefix="stitch_") as tmp_dir:
+        # Let every channel finish even if one fails — cancelling a task would
+        # orphan its ffmpeg process rather than stop it.
+        results = await asyncio.gather(
+            *(_encode_one(d, Path(tmp_dir)) for d in channel_dirs),
+            return_exceptions=True,
         )
+    failed: list[str] = []
+    for ch_dir, result in zip(channel_dirs, results):
+        if isinstance(result, BaseException):
+            logger.error(f"{ch_dir.name}: {result}")
+            failed.append(ch_dir.name)
+    if failed:
+        raise RuntimeError(f"Encoding failed for {', '.join(failed)}")
 
     logger.info(f"All videos written to {video_dir}")